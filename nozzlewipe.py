@@ -17,41 +17,125 @@ if __name__ == "__main__":
 
 import sys
 import math
+import bisect
+from array import array
 from collections import namedtuple
 
 
-GCode = namedtuple("GCode", "cmd args comment")
+# The numeric fields hold the X/Y/Z arguments already converted to floats
+# (None when absent), so that they are only converted once:
+GCode = namedtuple("GCode", "cmd args comment x y z")
+GCode.__new__.__defaults__ = (None, None, None)
 
-def parse_line(line):
-    lineparts = line.split(";", 1)
-    comment = ""
-    if len(lineparts) == 2:
-        comment = lineparts[1].rstrip()
-    cmdparts = lineparts[0].strip().split(" ")
-    cmd = cmdparts[0]
-    args = cmdparts[1:]
-    argdict = {arg[0]:arg[1:] for arg in args}
-    return GCode(cmd, argdict, comment)
 
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
 
-def distance(pos1, pos2):
-    return math.sqrt(
-        (float(pos1.args["X"]) - float(pos2.args["X"]))**2 +
-        (float(pos1.args["Y"]) - float(pos2.args["Y"]))**2)
 
+# A file only uses a handful of distinct feedrates. Share one copy of each
+# value string:
+feedrates = {}
 
-def extract_context(lines, count):
+def parse_line(line):
+    # Comments, M and T commands and blank lines can't take part in a hop.
+    # Skip the argument scan for those, nothing ever looks at their
+    # arguments:
+    first = line[:1]
+    if first == ";":
+        return GCode("", {}, line[1:].rstrip())
+    if first == "M" or first == "T" or first == "\n" or not first:
+        end = line.find(";")
+        comment = ""
+        if end < 0:
+            end = len(line)
+        else:
+            comment = line[end+1:].rstrip()
+        q = line.find(" ", 0, end)
+        if q < 0: q = end
+        return GCode(line[:q].rstrip(), {}, comment)
+
+    # Single left-to-right scan over the line, slicing each token out
+    # exactly once instead of splitting into intermediate lists:
+    end = line.find(";")
+    comment = ""
+    if end < 0:
+        end = len(line)
+    else:
+        comment = line[end+1:].rstrip()
+
+    # Trim surrounding whitespace by moving the bounds:
+    p = 0
+    while p < end and line[p].isspace(): p += 1
+    while end > p and line[end-1].isspace(): end -= 1
+
+    cmd = ""
+    argdict = {}
+    x = y = z = None
+    if p < end:
+        q = line.find(" ", p, end)
+        if q < 0: q = end
+        cmd = line[p:q]
+        p = q + 1
+        while p < end:
+            if line[p] == " ":
+                p += 1
+                continue
+            q = line.find(" ", p, end)
+            if q < 0: q = end
+            key = line[p]
+            value = line[p+1:q]
+            if key == "X": x = parse_float(value)
+            elif key == "Y": y = parse_float(value)
+            elif key == "Z": z = parse_float(value)
+            elif key == "F": value = feedrates.setdefault(value, value)
+            argdict[key] = value
+            p = q + 1
+    return GCode(cmd, argdict, comment, x, y, z)
+
+
+# Lazily parsed view of the input lines. Each line is parsed at most once,
+# on first access, and shared by process() and the hop context lookups:
+class Parsed(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.cache = [None] * len(lines)
+        # Line ending of the input, for the lines we add to it:
+        if lines and lines[0].endswith("\r\n"):
+            self.newline = "\r\n"
+        else:
+            self.newline = "\n"
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        gcode = self.cache[i]
+        if gcode is None:
+            gcode = self.cache[i] = parse_line(self.lines[i])
+        return gcode
+
+
+def extract_context(parsed, start, step, count):
+    # Walk from start in the given direction (-1 or +1) until enough moves
+    # have been collected and the Z position is known:
     moves = []
     z_pos = None
     collect = True
-    for line in lines:
-        gcode = parse_line(line)
-        if same_type and "TYPE:" in gcode.comment:
+    stop_at_type = same_type
+    end = len(parsed)
+    i = start
+    while 0 <= i < end:
+        gcode = parsed[i]
+        i += step
+        if stop_at_type and "TYPE:" in gcode.comment:
             collect = False
-        if "Z" in gcode.args:
-            z_pos = float(gcode.args["Z"])
+        if gcode.z is not None:
+            z_pos = gcode.z
             collect = False
-        if collect and "X" in gcode.args and "Y" in gcode.args:
+        if collect and gcode.x is not None and gcode.y is not None:
             moves.append(gcode)
         if len(moves) == count:
             collect = False
@@ -61,53 +145,80 @@ def extract_context(lines, count):
     return moves, z_pos
 
 
-def track_dist(moves):
+def wipe_offsets(moves):
+    # Distance of each move from the first one, and their total. The wipe
+    # distances are measured as the running total of these offsets along
+    # the wipe path:
+    sqrt = math.sqrt
+    offsets = array("d")
+    if moves:
+        x0, y0 = moves[0].x, moves[0].y
+        for m in moves:
+            dx = m.x - x0
+            dy = m.y - y0
+            offsets.append(sqrt(dx*dx + dy*dy))
+    return offsets, sum(offsets)
+
+
+def wipe_path(offsets, wipe_dist):
+    # Go back and forth along the moves until wipe_dist is covered, or
+    # until we're back at the start if the moves are too short for that.
+    # Returns the indices of the moves to visit and the distance travelled
+    # when reaching each of them, up to and including the first one that
+    # reaches wipe_dist:
+    count = len(offsets)
+    path = range(count) + range(count-1, -1, -1)
+    cum = array("d")
     dist = 0.0
-    steps = iter(moves)
-    last_step = next(steps)
-    yield last_step, dist
-    for step in steps:
-        delta = distance(step, last_step)
-        dist += delta
-        yield step, dist
+    for k in path:
+        dist += offsets[k]
+        cum.append(dist)
+    cutoff = bisect.bisect_left(cum, wipe_dist) + 1
+    return path[:cutoff], cum[:cutoff].tolist()
 
 
+def input_line(parsed, i):
+    # Original text of line i, newline-terminated even at the end of file:
+    line = parsed.lines[i]
+    if not line.endswith("\n"):
+        line += parsed.newline
+    return line
 
-def back_and_forth(seq):
-    forth = list(seq)
-    while True:
-        for o in forth:
-            yield o
-        for o in reversed(forth):
-            yield o
 
+def make_hop(parsed, retract, up, move, section, down, extrude):
+    # Yields the output text of the hop, given the indices of the lines
+    # matched by match_hop(). The matched lines are passed through as-is,
+    # the new ones are formatted directly.
+    target = parsed[move]
+    up_z = parsed[up].z
+    down_z = parsed[down].z
+    newline = parsed.newline
 
-def make_hop(lines, start, end, retract, up, move, section, down, extrude):
+    # Each wipe goes back and forth, so only half of it is spent going out:
+    takeoff_half = takeoff_dist / 2.0
+    landing_half = landing_dist / 2.0
 
-    yield GCode("", {}, "TYPE:Z-WIPE")
+    yield ";TYPE:Z-WIPE" + newline
 
-    moves_before, last_z = extract_context(lines[start-1::-1], 20)
-    dist_before = 0.0
-    for step, dist_before in track_dist(moves_before): pass
+    moves_before, last_z = extract_context(parsed, retract-1, -1, 20)
+    offsets_before, dist_before = wipe_offsets(moves_before)
 
     # Raise the nozzle a bit to avoid skinking into the surface
     # while we retract:
     if last_z is not None:
-        yield GCode("G0", {"Z":last_z + z_relief}, "raise a bit")
+        yield "G0 Z" + str(last_z + z_relief) + " ;raise a bit" + newline
 
-    yield retract
+    yield input_line(parsed, retract)
 
     # Wipe the nozzle by retracing the last few steps without extruding:
-    if dist_before > 0.0 and takeoff_dist > 0.0:
+    if dist_before > 0.0 and takeoff_half > 0.0:
         retraction_steps = []
-        for step, dist in track_dist(back_and_forth(moves_before)):
-            gcode = GCode("G1",
-                {"X":step.args["X"],
-                "Y":step.args["Y"],
-                "F":3000}, "wipe takeoff %.2f" % dist)
-            yield gcode
-            retraction_steps.append(gcode)
-            if dist >= takeoff_dist/2.0: break
+        for i, dist in zip(*wipe_path(offsets_before, takeoff_half)):
+            args = moves_before[i].args
+            step = ("G1 X" + args["X"] + " Y" + args["Y"] +
+                " F3000 ;wipe takeoff " + format(dist, ".2f") + newline)
+            yield step
+            retraction_steps.append(step)
 
         # Retrace again, back to the start:
         for step in reversed(retraction_steps):
@@ -115,145 +226,106 @@ def make_hop(lines, start, end, retract, up, move, section, down, extrude):
 
     # Hop to the next location, increasing Z gradually:
     if moves_before:
-        hop_dist = distance(moves_before[0], move)
+        dx = moves_before[0].x - target.x
+        dy = moves_before[0].y - target.y
+        hop_dist = math.sqrt(dx*dx + dy*dy)
     else:
         hop_dist = 0.0
-    z_next = float(down.args["Z"])
-    z_up = max(z_next + z_hop_per_mm * hop_dist, float(up.args["Z"]))
+    z_up = max(down_z + z_hop_per_mm * hop_dist, up_z)
 
-    hop = GCode("G0",
-        {"X":move.args["X"], "Y":move.args["Y"], "Z":z_up, "F":9000}, "hop")
-    yield hop
+    yield ("G0 X" + target.args["X"] + " Y" + target.args["Y"] +
+        " Z" + str(z_up) + " F9000 ;hop" + newline)
 
     # We're there. Lower the nozzle again:
-    yield GCode("G0", {"Z":float(down.args["Z"]) + z_relief}, "lower a bit")
+    yield "G0 Z" + str(down_z + z_relief) + " ;lower a bit" + newline
 
     # The nozzle may have drooled a bit during the move. Wipe it again
     # upon landing:
-    moves_after, _ = extract_context(lines[end:], 20)
-    dist_after = 0.0
-    for step, dist_after in track_dist(moves_after): pass
+    moves_after, _ = extract_context(parsed, extrude, +1, 20)
+    offsets_after, dist_after = wipe_offsets(moves_after)
 
-    if dist_after > 0.0 and landing_dist > 0.0:
-        last_step = moves_after[0]
+    if dist_after > 0.0 and landing_half > 0.0:
         landing_steps = []
-        for step, dist in track_dist(back_and_forth(moves_after)):
-            step = GCode("G1",
-                {"X":step.args["X"], "Y":step.args["Y"], "F":3000},
-                "wipe landing %.2f" % dist)
+        for i, dist in zip(*wipe_path(offsets_after, landing_half)):
+            args = moves_after[i].args
+            step = ("G1 X" + args["X"] + " Y" + args["Y"] +
+                " F3000 ;wipe landing " + format(dist, ".2f") + newline)
             yield step
             landing_steps.append(step)
-            if dist >= landing_dist/2.0: break
 
         for step in reversed(landing_steps):
             yield step
 
-    yield extrude
-    if section: yield section
-    yield down
-
-
-def gcode_to_string(gcode):
-    parts = []
-    if gcode.cmd: parts.append(gcode.cmd)
-    for pair in gcode.args.items():
-        parts.append("%s%s" % pair)
-    if gcode.comment:
-        parts.append(";%s" % gcode.comment)
-    return " ".join(parts)
+    yield input_line(parsed, extrude)
+    yield input_line(parsed, section)
+    yield input_line(parsed, down)
 
 
 # Example match:
-# G1 F3000 E929.45693
-# G1 Z33.000
-# G0 F9000 X73.472 Y27.640
-# ;TYPE:WALL-OUTER
-# G1 Z32.700
-# G1 F3000 E934.45693
-hop_pattern = [
-    ("G1", "FE", "retract", False),
-    ("G1", "Z", "up", False),
-    ("G0", lambda p: set("FXY").issubset(p), "move", False),
-    ("", "", "section", False),
-    ("G1", "Z", "down", False),
-    ("G1", "FE", "extrude", False),
-]
-
-class MatchResult(object):
-    def __init__(self, pattern):
-        self.fields = dict()
-        self.remaining = list(pattern)
-        self.start = -1
-        self.end = -1
-
-
-def match_gcode(gcode, match, i):
-    if not match.remaining: return i
-
-    cmd, args, name, optional = match.remaining[0]
-
-    if not callable(args):
-        match_args = lambda p: set(args) == p
-    else:
-        match_args = args
-    
-    matched = gcode.cmd == cmd and match_args(set(gcode.args.keys()))
-
-    if matched:
-        if match.start == -1: match.start = i
-        match.fields[name] = gcode
-        match.remaining.pop(0)
-        match.end = i
-        return -1
-
-    elif optional:
-        if match.start == -1: match.start = i
-        match.fields[name] = None
-        match.remaining.pop(0)
-        return match_gcode(gcode, match, i)
-
-    # Here: not matched, no optional
-    if match.start != -1:
-        return match.start
-    else:
-        return i
-
-
-
-def process(lines):
-    match = MatchResult(hop_pattern)
-    end = len(lines)
-    i = 0
-    while i < end:
-
-        gcode = parse_line(lines[i])
-
-        if gcode.cmd == "G91":
+# G1 F3000 E929.45693         retract
+# G1 Z33.000                  up
+# G0 F9000 X73.472 Y27.640    move
+# ;TYPE:WALL-OUTER            section
+# G1 Z32.700                  down
+# G1 F3000 E934.45693         extrude
+fe_args = frozenset("FE")
+z_args = frozenset("Z")
+fxy_args = frozenset("FXY")
+
+
+def match_hop(parsed, i):
+    # Match the pattern above at line i. Returns the indices of the matched
+    # lines, or None:
+    if i < 0 or i + 5 >= len(parsed):
+        return None
+
+    retract = parsed[i]
+    if not (retract.cmd == "G1" and retract.args.viewkeys() == fe_args):
+        return None
+    up = parsed[i+1]
+    if not (up.cmd == "G1" and up.args.viewkeys() == z_args):
+        return None
+    move = parsed[i+2]
+    if not (move.cmd == "G0" and move.args.viewkeys() >= fxy_args):
+        return None
+    section = parsed[i+3]
+    if not (section.cmd == "" and not section.args):
+        return None
+    down = parsed[i+4]
+    if not (down.cmd == "G1" and down.args.viewkeys() == z_args):
+        return None
+    extrude = parsed[i+5]
+    if not (extrude.cmd == "G1" and extrude.args.viewkeys() == fe_args):
+        return None
+    return i, i+1, i+2, i+3, i+4, i+5
+
+
+def process(parsed):
+    # Yields the output text. A hop always has a "G1 Z" line right after
+    # its first line, so only the lines before those are tried as the start
+    # of a match. Everything in between is passed through as-is, without
+    # being parsed.
+    lines = parsed.lines
+    candidates = []
+    for i, line in enumerate(lines):
+        if line.startswith("G1 Z"):
+            candidates.append(i)
+        elif line.startswith("G91") and parsed[i].cmd == "G91":
             raise Exception("Relative mode is not supported")
 
-        rewind = match_gcode(gcode, match, i)
-        if not match.remaining:
-            # Match complete:
-            for new_code in make_hop(lines, match.start, match.end, **match.fields):
-                yield new_code
-            match = MatchResult(hop_pattern)
-
-        if rewind != -1:
-            # The last line did not match, rewind to the specified position,
-            # pass that line through and start a new match:
-            if rewind != i:
-                gcode = parse_line(lines[rewind])
-                i = rewind
-            yield gcode
-            if match.start != -1:
-                match = MatchResult(hop_pattern)
+    done = 0
+    for i in candidates:
+        start = i - 1
+        if start < done:
+            continue
+        hop = match_hop(parsed, start)
+        if hop is None:
+            continue
+        yield "".join(lines[done:start])
+        yield "".join(make_hop(parsed, *hop))
+        done = hop[-1] + 1
 
-        # next line:
-        i += 1
-
-    if match.remaining and match.start != -1:
-        for i in range(match.start, end):
-            yield parse_line(lines[i])
+    yield "".join(lines[done:])
 
 
 
@@ -261,14 +333,15 @@ if __name__ == "__main__":
     with open(sys.argv[1], "r") as f:
         lines = f.readlines()
 
-    for gcode in process(lines):
-        print gcode_to_string(gcode)
+    sys.stdout.writelines(process(Parsed(lines)))
 
 else:
     with open(filename, "r") as f:
         lines = f.readlines()
 
-    with open(filename, "w") as f:
-        for gcode in process(lines):
-            f.write(gcode_to_string(gcode))
-            f.write("\n")
+    # Render everything before truncating the file, so that it's left
+    # untouched if processing fails:
+    output = list(process(Parsed(lines)))
+
+    with open(filename, "w", 1 << 16) as f:
+        f.writelines(output)